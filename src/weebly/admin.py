@@ -1,31 +1,48 @@
 from django.contrib import admin
 from .models import *
+from .util import run_concurrently
 
 
 class WeeblyStoreProductOptionInline(admin.TabularInline):
     model = WeeblyStoreProductOption
 
 
-class WeeblyStoreProductAdmin(ModelAdmin, SiteDomainMixin):
+class WeeblyStoreProductAdmin(ModelAdmin, LocalSiteDomainMixin):
     list_display = ['pk', 'product_id', 'site_domain', 'name', 'url_linked']
-    search_fields = ['product_id', 'name', 'url', 'site__domain']
+    search_fields = ['product_id', 'name', 'url', 'site_domain_copy']
     readonly_fields = ['site', 'site_domain']
     inlines = [WeeblyStoreProductOptionInline]
 
     actions = ['refresh_from_weebly', 'refresh_options']
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('description')
+
     @domain_decorator(title="url", admin_order_field='url')
     def url_linked(self, obj): return obj.url
 
     @RunInThread
     def refresh_from_weebly(self, _, queryset):
-        for product in queryset:
-            product.refresh_from_weebly()
+        auth_by_site = {}
+        # refreshing compares the description, so not deferring it
+        queryset = queryset.defer(None).select_related('site')
+        products = [(product, get_site_auth(auth_by_site, product.site)) for product in queryset]
+        run_concurrently(lambda p: p[0].refresh_from_weebly(weebly_auth=p[1]), products)
 
     @RunInThread
     def refresh_options(self, _, queryset):
-        for product in queryset:
-            product.refresh_options()
+        auth_by_site = {}
+        products = [(product, get_site_auth(auth_by_site, product.site)) for product in queryset.select_related('site')]
+        run_concurrently(lambda p: p[0].refresh_options(weebly_auth=p[1]), products)
+
+
+def get_site_auth(auth_by_site, site):
+    """
+    gets the default weebly auth for the site, resolving it only once per site
+    """
+    if site.pk not in auth_by_site:
+        auth_by_site[site.pk] = site.get_default_weebly_auth()
+    return auth_by_site[site.pk]
 
 
 admin.site.register(WeeblyUser, WeeblyUser.Admin)
@@ -6,5 +6,9 @@ class WeeblyConfig(AppConfig):
     name = 'weebly'
 
     def ready(self):
-        from weebly.models import WeeblyPaymentNotification
+        from weebly.models import WeeblyPaymentNotification, WeeblySite, WeeblyPage, WeeblyBlog, WeeblyStoreProduct, \
+            set_site_domain
         pre_save.connect(WeeblyPaymentNotification.pre_save, WeeblyPaymentNotification)
+        post_save.connect(WeeblySite.post_save, WeeblySite)
+        for model in [WeeblyPage, WeeblyBlog, WeeblyStoreProduct]:
+            pre_save.connect(set_site_domain, model)
@@ -0,0 +1,43 @@
+# Generated by Django 4.1.2 on 2026-10-15 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weebly', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='weeblyblog',
+            name='blog_id',
+            field=models.BigIntegerField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='weeblyblogpost',
+            name='post_id',
+            field=models.BigIntegerField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='weeblypage',
+            name='parent_id',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='weeblypaymentnotification',
+            name='notified_to_weebly',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AlterField(
+            model_name='weeblysite',
+            name='site_id',
+            field=models.BigIntegerField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='weeblyuser',
+            name='user_id',
+            field=models.BigIntegerField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.1.2 on 2026-10-15 11:03
+
+from django.db import migrations, models
+
+
+def copy_site_domains(apps, schema_editor):
+    WeeblySite = apps.get_model('weebly', 'WeeblySite')
+    for model_name in ['WeeblyPage', 'WeeblyBlog', 'WeeblyStoreProduct']:
+        model = apps.get_model('weebly', model_name)
+        domain = WeeblySite.objects.filter(pk=models.OuterRef('site_id')).values('domain')[:1]
+        model.objects.update(site_domain=models.Subquery(domain))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weebly', '0002_add_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weeblyblog',
+            name='site_domain',
+            field=models.CharField(blank=True, db_index=True, max_length=512, null=True),
+        ),
+        migrations.AddField(
+            model_name='weeblypage',
+            name='site_domain',
+            field=models.CharField(blank=True, db_index=True, max_length=512, null=True),
+        ),
+        migrations.AddField(
+            model_name='weeblystoreproduct',
+            name='site_domain',
+            field=models.CharField(blank=True, db_index=True, max_length=512, null=True),
+        ),
+        migrations.RunPython(copy_site_domains, migrations.RunPython.noop),
+    ]
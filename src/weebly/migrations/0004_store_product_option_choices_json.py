@@ -0,0 +1,24 @@
+# Generated by Django 4.1.2 on 2026-10-15 12:21
+
+from django.db import migrations, models
+
+
+def fix_empty_choices(apps, schema_editor):
+    WeeblyStoreProductOption = apps.get_model('weebly', 'WeeblyStoreProductOption')
+    WeeblyStoreProductOption.objects.filter(choices='').update(choices='[]')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weebly', '0003_denormalize_site_domain'),
+    ]
+
+    operations = [
+        migrations.RunPython(fix_empty_choices, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='weeblystoreproductoption',
+            name='choices',
+            field=models.JSONField(default=list),
+        ),
+    ]
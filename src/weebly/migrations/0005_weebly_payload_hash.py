@@ -0,0 +1,33 @@
+# Generated by Django 4.1.2 on 2026-10-15 14:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weebly', '0004_store_product_option_choices_json'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weeblyblogpost',
+            name='weebly_payload_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='weeblysite',
+            name='weebly_payload_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='weeblystoreproduct',
+            name='weebly_payload_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='weeblyuser',
+            name='weebly_payload_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True),
+        ),
+    ]
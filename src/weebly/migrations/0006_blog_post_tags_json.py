@@ -0,0 +1,25 @@
+# Generated by Django 4.1.2 on 2026-10-15 16:05
+
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def fix_empty_tags(apps, schema_editor):
+    WeeblyBlogPost = apps.get_model('weebly', 'WeeblyBlogPost')
+    WeeblyBlogPost.objects.filter(Q(tags__isnull=True) | Q(tags='')).update(tags='{}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weebly', '0005_weebly_payload_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(fix_empty_tags, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='weeblyblogpost',
+            name='tags',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.2 on 2026-10-15 18:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weebly', '0006_blog_post_tags_json'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='weeblyblog',
+            old_name='site_domain',
+            new_name='site_domain_copy',
+        ),
+        migrations.RenameField(
+            model_name='weeblypage',
+            old_name='site_domain',
+            new_name='site_domain_copy',
+        ),
+        migrations.RenameField(
+            model_name='weeblystoreproduct',
+            old_name='site_domain',
+            new_name='site_domain_copy',
+        ),
+    ]
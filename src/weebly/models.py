@@ -1,50 +1,68 @@
 import logging
-import json
+import hashlib
+import re
+import threading
+import contextvars
+from contextlib import contextmanager
 import jwt
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import timedelta
-from collections.abc import Iterable
+from functools import lru_cache
+from itertools import islice
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.admin import ModelAdmin
+from django.contrib.admin.views.main import ChangeList
 from django.urls import reverse
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Model
-from django.db.models import CASCADE
+from django.db.models import CASCADE, DEFERRED
 from django.utils.safestring import mark_safe
 from django.utils import timezone
-from django.utils.html import format_html
+from django.utils.html import format_html_join
 from tinymce import models as tinymce_models
 
 from marto_python.strings import to_decimal
 from marto_python.threads import RunInThread
 
 from .signals import site_refreshed_signal
+from .util import run_concurrently, cached_method
 
 from . import refresh
 
 logger = logging.getLogger(__name__)
 
+# shared session for the weebly api, so connections are pooled between requests
+# only idempotent methods are retried, so payments are never reported twice
+weebly_session = requests.Session()
+weebly_session.headers['Accept'] = 'application/vnd.weebly.v1+json'
+weebly_session.mount('https://', HTTPAdapter(pool_connections=10,
+                                             pool_maxsize=50,
+                                             max_retries=Retry(total=3,
+                                                               backoff_factor=0.3,
+                                                               status_forcelist=[502, 503, 504])))
+
 
 def domain_decorator(title='domain', admin_order_field=None):
     """
     makes a domain clickable in admin
     """
     def real_decorator(func):
-        @mark_safe
         def decorated(*args, **kwargs):
             val = func(*args, **kwargs)
             if not val:
                 return None
             elif isinstance(val, str):
                 domains = [val]
-            elif isinstance(val, Iterable):
+            elif isinstance(val, (list, tuple, set, frozenset, models.QuerySet)):
                 domains = val
             else:
                 return None
-
-            domains = [d if d.startswith('http') else f'http://{d}' for d in domains]
-            domains = [f'<a href="{d}" target="_blank">{d}</a>' for d in domains]
-            return format_html(' '.join(domains))
+            # format_html_join already returns a safe string
+            return format_html_join(' ', '<a href="{0}" target="_blank">{0}</a>',
+                                    ((d if d.startswith('http') else f'http://{d}',) for d in domains))
 
         decorated.short_description = title
         if admin_order_field:
@@ -54,31 +72,130 @@ def domain_decorator(title='domain', admin_order_field=None):
     return real_decorator
 
 
+PUBLISH_EXPECTED_ERRORS = (
+    'This site cannot be published',
+    'Questo sito non può essere pubblicato',
+    'CAPTCHA',
+    'Product count is too high',
+    'Produktanzahl ist zu hoch',
+    '产品计数太高',
+    'Unable to build new Snapshot',
+    'Member count is too high',
+    'findShard failed',
+    'Account Verification',
+    'Accountverificatie',
+    'Este site não pode ser publicado',
+    'Es necesario verificar la cuenta antes de publicar',
+    'El número de suscripciones es demasiado alto',
+    'Le nombre de membre est trop élevé',
+)
+
+
+@lru_cache(maxsize=None)
+def expected_errors_regex(expected_errors):
+    """
+    a single regex matching any of the expected errors, compiled once per tuple of errors
+    """
+    return re.compile('|'.join(re.escape(error) for error in expected_errors + ('Unknown api key',)))
+
+
+# site pk -> site with a pending change signal, while inside deferred_site_signals()
+deferred_signals = contextvars.ContextVar('deferred_signals', default=None)
+
+
+@contextmanager
+def deferred_site_signals():
+    """
+    Inside this context, site change signals are collected and sent when leaving it,
+    once per site and after the current transaction commits.
+    For refreshing many things of a site, or many sites, in one go.
+    Seen by the run_concurrently workers started inside it.
+    """
+    if deferred_signals.get() is not None:
+        yield  # already deferring
+        return
+    sites = {}
+    token = deferred_signals.set(sites)
+    try:
+        yield
+    finally:
+        deferred_signals.reset(token)
+        for site in sites.values():
+            transaction.on_commit(site.signal_change)
+
+
+# user_id -> [lock, WeeblyUser], while inside cached_weebly_users()
+cached_users = contextvars.ContextVar('cached_users', default=None)
+
+
+@contextmanager
+def cached_weebly_users():
+    """
+    Inside this context, WeeblyUser.get_or_create_cached() looks up each user only once.
+    Seen by the run_concurrently workers started inside it, for concurrent refreshes of many sites.
+    """
+    if cached_users.get() is not None:
+        yield  # already caching
+        return
+    token = cached_users.set({})
+    try:
+        yield
+    finally:
+        cached_users.reset(token)
+
+
 # noinspection PyClassHasNoInit
-class SiteDomainMixin:
+class SiteDomainSelectRelatedMixin:
+    """
+    Selects the relations that site_domain goes through in the admin queryset.
+    Only takes effect when the mixin comes before ModelAdmin in the bases.
+    """
+    site_domain_select_related = ()
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(*self.site_domain_select_related)
+
+
+class SiteDomainMixin(SiteDomainSelectRelatedMixin):
     """
     Mixin for admin classes that adds the site_domain property
     """
+    site_domain_select_related = ('site',)
+
     @mark_safe
     @domain_decorator(title='site domain', admin_order_field='site__domain')
     def site_domain(self, obj):
         return obj.site.domain if obj.site else None
 
 
-class AccountSiteDomainMixin:
+class LocalSiteDomainMixin:
+    """
+    Mixin for admin classes that adds the site_domain property, from the model's own site_domain_copy
+    """
+    @mark_safe
+    @domain_decorator(title='site domain', admin_order_field='site_domain_copy')
+    def site_domain(self, obj):
+        return obj.site_domain_copy
+
+
+class AccountSiteDomainMixin(SiteDomainSelectRelatedMixin):
     """
     Mixin for admin classes that adds the site_domain property, through the account property
     """
+    site_domain_select_related = ('account__site',)
+
     @mark_safe
     @domain_decorator(title='site domain', admin_order_field='account__site__domain')
     def site_domain(self, obj):
         return obj.account.site.domain if obj.account else None
 
 
-class PageSiteDomainMixin:
+class PageSiteDomainMixin(SiteDomainSelectRelatedMixin):
     """
     Mixin for admin classes that adds the site_domain property, through the page property
     """
+    site_domain_select_related = ('page__weebly_page__site',)
+
     @mark_safe
     @domain_decorator(title='site domain', admin_order_field='page__site__domain')
     def site_domain(self, obj):
@@ -86,9 +203,10 @@ class PageSiteDomainMixin:
 
 
 class WeeblyUser(Model):
-    user_id = models.BigIntegerField()
+    user_id = models.BigIntegerField(db_index=True)
     name = models.CharField(max_length=256, null=True, blank=True)
     email = models.EmailField(null=True, blank=True)
+    weebly_payload_hash = models.CharField(max_length=32, null=True, blank=True, editable=False)
 
     def __str__(self):
         return str(self.user_id)
@@ -101,13 +219,23 @@ class WeeblyUser(Model):
 
     @staticmethod
     def get_or_create(user_id):
-        user = WeeblyUser.objects.filter(user_id=user_id)
-        if user.exists():
-            return user.get()
-        else:
-            user = WeeblyUser(user_id=user_id)
-            user.save()
-            return user
+        user, _ = WeeblyUser.objects.get_or_create(user_id=user_id)
+        return user
+
+    @staticmethod
+    def get_or_create_cached(user_id):
+        """
+        get_or_create, cached inside cached_weebly_users()
+        """
+        cache = cached_users.get()
+        if cache is None:
+            return WeeblyUser.get_or_create(user_id)
+        # a lock per user, so the same new user is not created twice and different users don't wait
+        entry = cache.setdefault(int(user_id), [threading.Lock(), None])
+        with entry[0]:
+            if entry[1] is None:
+                entry[1] = WeeblyUser.get_or_create(user_id)
+            return entry[1]
 
     class Admin(ModelAdmin):
         list_display = ['user_id', 'name', 'email']
@@ -116,51 +244,83 @@ class WeeblyUser(Model):
 
         @RunInThread
         def refresh_from_weebly(self, _, queryset):
-            for user in queryset:
+            def refresh_user(user):
                 weebly_auth = user.get_default_weebly_auth()
                 if not weebly_auth:
                     logger.info(f'{user} - no valid weebly auth found for user')
-                    continue
+                    return
                 user.refresh_from_weebly(weebly_auth=weebly_auth)
+            run_concurrently(refresh_user, queryset)
 
 
 class WeeblySite(Model):
-    site_id = models.BigIntegerField()
+    site_id = models.BigIntegerField(db_index=True)
     user = models.ForeignKey(WeeblyUser, null=True, blank=True, on_delete=CASCADE)
     site_title = models.CharField(max_length=1024, null=True, blank=True)
     domain = models.CharField(max_length=512, null=True, blank=True)
     is_published = models.BooleanField(default=False)
     language = models.CharField(max_length=8, null=True, blank=True)
     is_found = models.BooleanField(default=True)
+    weebly_payload_hash = models.CharField(max_length=32, null=True, blank=True, editable=False)
+
+    _default_weebly_auth = None
+    _saved_domain = DEFERRED  # the domain in the db, when known
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        site = super().from_db(db, field_names, values)
+        if 'domain' in field_names:
+            site._saved_domain = site.domain
+        return site
 
     def refresh_from_weebly(self, weebly_auth=None): return refresh.refresh_site(self, weebly_auth=weebly_auth)
     def refresh_pages(self, weebly_auth=None, signal_change=False): return refresh.refresh_pages(self, weebly_auth=weebly_auth, signal_change=signal_change)
-    def refresh_blogs(self, refresh_posts=False): return refresh.refresh_blogs(self, refresh_posts=refresh_posts)
+    def refresh_blogs(self, refresh_posts=False, weebly_auth=None): return refresh.refresh_blogs(self, refresh_posts=refresh_posts, weebly_auth=weebly_auth)
     def refresh_store_products(self, weebly_auth=None, signal_change=False): return refresh.refresh_store_products(self, weebly_auth=weebly_auth, signal_change=signal_change)
     def refresh_store_categories(self, weebly_auth=None, signal_change=False): return refresh.refresh_store_categories(self, weebly_auth=weebly_auth, signal_change=signal_change)
     def refresh_store(self, weebly_auth=None, signal_change=False): return refresh.refresh_store(self, weebly_auth=weebly_auth, signal_change=signal_change)
 
     def signal_change(self):
+        """
+        sends the change signal, or defers it when inside deferred_site_signals()
+        """
+        pending = deferred_signals.get()
+        if pending is not None:
+            pending[self.pk] = self
+            return
         logger.info(f'{self} - sending change signal')
         site_refreshed_signal.send(sender=self)
 
+    # noinspection PyUnusedLocal
+    @staticmethod
+    def post_save(sender, instance, created, update_fields=None, **kwargs):
+        """
+        keeps the site_domain_copy of the site's pages, blogs and products up to date
+        only queries when the domain was saved and may have changed
+        """
+        if update_fields is not None and 'domain' not in update_fields: return
+        if not created and instance.domain != instance._saved_domain:
+            for related_manager in [instance.pages, instance.blogs, instance.store_products]:
+                related_manager.exclude(site_domain_copy=instance.domain).update(site_domain_copy=instance.domain)
+        instance._saved_domain = instance.domain
+
     def __str__(self):
         return f'site_{self.site_id}'
 
     def get_default_weebly_auth(self):
-        qs = self.weeblyauth_set
-        auth_for_user = qs.filter(user=self.user).last()
-        return auth_for_user if auth_for_user else qs.last()
+        """
+        the weebly auth for the site owner, or any other one. Cached in the instance.
+        """
+        if not self._default_weebly_auth:
+            qs = self.weeblyauth_set
+            auth_for_user = qs.filter(user_id=self.user_id).last() if self.user_id else None
+            self._default_weebly_auth = auth_for_user if auth_for_user else qs.last()
+        return self._default_weebly_auth
 
     @staticmethod
     def get_or_create(site_id):
-        site = WeeblySite.objects.filter(site_id=site_id)
-        if site.exists():
-            return site.get()
-        else:
-            site = WeeblySite(site_id=site_id)
-            site.save()
-            return site
+        site, _ = WeeblySite.objects.get_or_create(site_id=site_id)
+        return site
 
     class Admin(ModelAdmin):
         list_display = ['site_id', 'site_title', 'domain', 'user', 'is_published', 'is_found', 'language']
@@ -168,11 +328,13 @@ class WeeblySite(Model):
         search_fields = ['site_id', 'domain', 'user__user_id', 'user__email']
         actions = ['refresh_from_weebly']
 
+        def get_queryset(self, request):
+            return super().get_queryset(request).select_related('user')
+
         @RunInThread
         def refresh_from_weebly(self, _, queryset):
-            for site in queryset:
-                weebly_auth = site.get_default_weebly_auth()
-                site.refresh_from_weebly(weebly_auth)
+            with deferred_site_signals(), cached_weebly_users():
+                run_concurrently(lambda site: site.refresh_from_weebly(site.get_default_weebly_auth()), queryset)
 
 
 class WeeblyAuth(Model):
@@ -230,48 +392,51 @@ class WeeblyAuth(Model):
         search_fields = ['id', 'user__user_id', 'user__name', 'user__email', 'site__site_id', 'site__domain']
         actions = ['refresh_from_weebly', 'deauthorize']
 
+        def get_queryset(self, request):
+            return super().get_queryset(request).select_related('user', 'site')
+
         @RunInThread
         def refresh_from_weebly(self, _, queryset):
-            for weebly_auth in queryset:
-                weebly_auth.refresh_from_weebly()
+            # several auths can be for the same site or user, signaling each site once
+            with deferred_site_signals(), cached_weebly_users():
+                run_concurrently(lambda weebly_auth: weebly_auth.refresh_from_weebly(), queryset)
 
         @RunInThread
         def deauthorize(self, _, queryset):
-            for weebly_auth in queryset:
-                weebly_auth.deauthorize()
+            run_concurrently(lambda weebly_auth: weebly_auth.deauthorize(), queryset)
 
     def __str__(self):
         return f'user_{self.user.user_id}-site_{self.site.site_id}'
 
     @staticmethod
     def get_or_create(user_id, site_id, version):
-        weebly_auth = WeeblyAuth.objects.filter(user__user_id=user_id, site__site_id=site_id).first()
+        weebly_auth = WeeblyAuth.objects.select_related('user', 'site')\
+            .filter(user__user_id=user_id, site__site_id=site_id).first()
         if not weebly_auth:
             user = WeeblyUser.get_or_create(user_id)
             site = WeeblySite.get_or_create(site_id)
-            weebly_auth = WeeblyAuth(user=user, site=site, version=version)
-            weebly_auth.save()
-        else:
-            if version and version != weebly_auth.version:
-                weebly_auth.version = version
-                weebly_auth.save()
+            weebly_auth, _ = WeeblyAuth.objects.get_or_create(user=user, site=site, defaults={'version': version})
+        elif version and version != weebly_auth.version:
+            weebly_auth.version = version
+            WeeblyAuth.objects.filter(pk=weebly_auth.pk).update(version=version)
         return weebly_auth
 
-    def __make_weebly_request(self, path, params=None, method='get', data=None, action_name='doing weebly request'):
+    def __make_weebly_request(self, path, label, params=None, method='get', data=None,
+                              action_name='doing weebly request'):
         if not params: params = {}
         if not data: data = {}
-        if not self.is_valid: logger.warning(f'{self} - making request with invalid weebly auth')
+        if not self.is_valid: logger.warning(f'{label} - making request with invalid weebly auth')
         headers = {
-            'Accept': 'application/vnd.weebly.v1+json',
             'User-Agent': settings.WEEBLY_APP_NAME,
             'X-Weebly-Access-Token': self.auth_token,
         }
         url = 'https://api.weebly.com' + path
         logger.info(f'{action_name} - {method.upper()} {url}')
-        return requests.request(method, url, headers=headers, params=params, json=data, timeout=60)
+        return weebly_session.request(method, url, headers=headers, params=params, json=data, timeout=60)
 
-    def __handle_response(self,
-                          resp,
+    @staticmethod
+    def __handle_response(resp,
+                          label,
                           action_name='doing weebly request',
                           expected_errors=None):
         if not expected_errors: expected_errors = []
@@ -289,45 +454,97 @@ class WeeblyAuth(Model):
             if 'error' in resp_json:
                 resp_error = resp_json['error']['message']
                 rv_error += f' - {resp_error}'
-                msg = f'{rv_error} - {self}'
-                error_is_expected = False
-                for error in expected_errors + ['Unknown api key']:
-                    if error in msg:
-                        error_is_expected = True
-                        break
+                msg = f'{rv_error} - {label}'
+                error_is_expected = expected_errors_regex(tuple(expected_errors)).search(msg) is not None
                 logger.log(logging.WARN if error_is_expected else logging.ERROR, msg)
             rv['error'] = 'Error ' + rv_error
-        self.check_still_valid(rv)
         return rv, resp_json
 
+    def __request(self, path, label, params, method, data, action_name, expected_errors):
+        """
+        the http request and its json, without DB access so it can run in other threads
+        label is str(self), computed beforehand as it loads the user and site
+        """
+        try:
+            resp = self.__make_weebly_request(path, label, params, method, data, action_name)
+            return WeeblyAuth.__handle_response(resp, label, action_name, expected_errors=expected_errors)
+        except requests.RequestException as e:
+            message = f'{type(e)} - {e}'
+            logger.error(f'request error while {action_name}: {message}', exc_info=True)
+            return {'error': message}, None
+
+    def __request_cache_key(self, path, params):
+        """
+        cache key for a GET request, versioned so that any other request for this auth invalidates it
+        """
+        version = cache.get_or_set(f'weebly_request_version_{self.pk}', 0, timeout=None)
+        request_hash = hashlib.blake2b(repr((path, sorted(params.items()))).encode(), digest_size=16).hexdigest()
+        return f'weebly_request_{self.pk}_{version}_{request_hash}'
+
+    def __invalidate_request_cache(self):
+        """
+        the version is only created by cached GETs, so without it there is nothing to invalidate
+        """
+        try:
+            cache.incr(f'weebly_request_version_{self.pk}')
+        except ValueError:
+            pass  # no cached GETs, or dummy cache
+
     def weebly_request(self,
                        path, params=None, method='get', data=None,
                        action_name='doing weebly request',
-                       expected_errors=None):
+                       expected_errors=None,
+                       cache_timeout=None):
         """
         helper method combination of the previous two
+        If cache_timeout is set, successful GET responses are cached for that many seconds.
         """
         if not params: params = {}
         if not data: data = {}
-        try:
-            resp = self.__make_weebly_request(path, params, method, data, action_name)
-            return self.__handle_response(resp, action_name, expected_errors=expected_errors)
-        except requests.RequestException as e:
-            message = f'{type(e)} - {e}'
-            logger.error(f'request error while {action_name}: {message}', exc_info=True)
-            return {'error': message}, None
+        cache_key = None
+        if method.lower() != 'get':
+            self.__invalidate_request_cache()
+        elif cache_timeout:
+            cache_key = self.__request_cache_key(path, params)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logger.debug(f'{action_name} - cached GET {path}')
+                return cached
+        rv, resp_json = self.__request(path, str(self), params, method, data, action_name, expected_errors)
+        if 'error' in rv and resp_json is None: return rv, resp_json  # no response from weebly
+        self.check_still_valid(rv)
+        if cache_key and 'error' not in rv:
+            cache.set(cache_key, (rv, resp_json), timeout=cache_timeout)
+        return rv, resp_json
 
-    def weebly_request_paginated(self,
-                                 path, params=None, method='get', data=None,
-                                 action_name='doing weebly request',
-                                 limit_count=200, expected_errors=None):
+    def weebly_requests_concurrent(self,
+                                   requests_args,
+                                   action_name='doing weebly request',
+                                   expected_errors=None, max_workers=8):
+        """
+        GET requests for a list of (path, params), concurrently. Returns their (rv, resp_json) in the same order.
+        Only the http requests run in other threads, the auth is checked and saved in this one.
+        """
+        label = str(self)
+        responses = run_concurrently(lambda args: self.__request(args[0], label, args[1] or {}, 'get', {},
+                                                                 action_name, expected_errors),
+                                     requests_args, max_workers)
+        for rv, resp_json in responses:
+            if 'error' in rv and resp_json is None: continue  # no response from weebly
+            self.check_still_valid(rv)
+        return responses
+
+    def weebly_request_stream(self,
+                              path, params=None, method='get', data=None,
+                              action_name='doing weebly request',
+                              limit_count=200, expected_errors=None, cache_timeout=None):
         """
-        helper method for doing paginated requests
+        generator for paginated requests, yields the (rv, resp_json) of each page as soon as it arrives
+        stops after the last page or after the first error
         """
         if not params: params = {}
         if not data: data = {}
         page = 1
-        response_json = []
         new_params = params.copy()
         new_params['limit'] = limit_count
         while True:
@@ -337,34 +554,68 @@ class WeeblyAuth(Model):
                                                 method=method,
                                                 data=data,
                                                 action_name=action_name,
-                                                expected_errors=expected_errors)
+                                                expected_errors=expected_errors,
+                                                cache_timeout=cache_timeout)
+            yield rv, resp_json
+            if 'error' in rv or len(resp_json) < limit_count:
+                return
+            page += 1
+            logger.info(f'paginated request to weebly, page {page}')
+
+    def weebly_request_paginated(self,
+                                 path, params=None, method='get', data=None,
+                                 action_name='doing weebly request',
+                                 limit_count=200, expected_errors=None, cache_timeout=None):
+        """
+        helper method for doing paginated requests, returns all the pages together
+        """
+        response_json = []
+        for rv, resp_json in self.weebly_request_stream(path,
+                                                        params=params,
+                                                        method=method,
+                                                        data=data,
+                                                        action_name=action_name,
+                                                        limit_count=limit_count,
+                                                        expected_errors=expected_errors,
+                                                        cache_timeout=cache_timeout):
             if 'error' in rv:
                 return rv, response_json
             response_json += resp_json
-            page += 1
-            if len(resp_json) < limit_count:
-                return {}, response_json
-            logger.info(f'paginated request to weebly, page {page}')
+        return {}, response_json
+
+    def weebly_request_paginated_concurrent(self,
+                                            path, params=None,
+                                            action_name='doing weebly request',
+                                            limit_count=200, expected_errors=None, max_workers=8):
+        """
+        like weebly_request_paginated for GET requests, but requests several pages at a time.
+        The first page is requested alone, most responses fit in it. While pages come back full, the next
+        pages are requested in rounds doubling in size up to max_workers, to keep requests past the end few.
+        """
+        if not params: params = {}
+        response_json = []
+        first_page = 1
+        round_size = 1
+        while True:
+            pages = self.weebly_requests_concurrent([(path, dict(params, limit=limit_count, page=page))
+                                                     for page in range(first_page, first_page + round_size)],
+                                                    action_name=action_name,
+                                                    expected_errors=expected_errors,
+                                                    max_workers=round_size)
+            for rv, resp_json in pages:
+                if 'error' in rv:
+                    return rv, response_json
+                response_json += resp_json
+                if len(resp_json) < limit_count:
+                    return {}, response_json
+            first_page += round_size
+            round_size = min(round_size * 2, max_workers)
+            logger.info(f'paginated request to weebly, page {first_page}')
 
     def publish_site(self):
         path = f'/v1/user/sites/{self.site.site_id}/publish'
-        rv, _ = self.weebly_request(path, method='post', action_name='publishing site', expected_errors=[
-            'This site cannot be published',
-            'Questo sito non può essere pubblicato',
-            'CAPTCHA',
-            'Product count is too high',
-            'Produktanzahl ist zu hoch',
-            '产品计数太高',
-            'Unable to build new Snapshot',
-            'Member count is too high',
-            'findShard failed',
-            'Account Verification',
-            'Accountverificatie',
-            'Este site não pode ser publicado',
-            'Es necesario verificar la cuenta antes de publicar',
-            'El número de suscripciones es demasiado alto',
-            'Le nombre de membre est trop élevé',
-        ])
+        rv, _ = self.weebly_request(path, method='post', action_name='publishing site',
+                                    expected_errors=PUBLISH_EXPECTED_ERRORS)
         return rv
 
     def publish_snippet(self, snippet):
@@ -412,14 +663,18 @@ class WeeblyPage(Model):
     page_url = models.CharField(max_length=1024, blank=True, null=True)
     hidden = models.BooleanField(default=False)
     page_order = models.IntegerField(default=0)
-    parent_id = models.BigIntegerField(blank=True, null=True)
-    
+    parent_id = models.BigIntegerField(blank=True, null=True, db_index=True)
+    site_domain_copy = models.CharField(max_length=512, null=True, blank=True, db_index=True)
+
+    _site_tree = None
+
     def site_domain(self):
-        return self.site.domain
-    
+        return self.site_domain_copy
+
     def __str__(self):
         return self.title
     
+    @cached_method
     def is_link(self):
         if not self.page_url: return False
         url_lower = self.page_url.lower()
@@ -432,52 +687,111 @@ class WeeblyPage(Model):
     def children_qs(self):
         return WeeblyPage.objects.filter(parent_id=self.page_id)
 
+    def get_site_tree(self):
+        """
+        the tree of the site's pages as page_id -> (parent_id, page_order), loaded in a single query
+        cached in the instance, or shared between pages by share_site_trees
+        """
+        if self._site_tree is None:
+            self._site_tree = WeeblyPage.load_site_trees([self.site_id])[self.site_id]
+        return self._site_tree
+
+    @staticmethod
+    def load_site_trees(site_ids):
+        trees = {site_id: {} for site_id in site_ids}
+        pages_values = WeeblyPage.objects.filter(site_id__in=site_ids).order_by('pk')\
+            .values_list('site_id', 'page_id', 'parent_id', 'page_order')
+        for site_id, page_id, parent_id, page_order in pages_values:
+            trees[site_id][page_id] = (parent_id, page_order)
+        return trees
+
+    @staticmethod
+    def share_site_trees(pages):
+        """
+        loads the site trees of all the pages in a single query, one tree shared by the pages of each site
+        """
+        trees = WeeblyPage.load_site_trees({page.site_id for page in pages})
+        for page in pages:
+            page._site_tree = trees[page.site_id]
+
+    @staticmethod
+    def pages_by_id(page_ids):
+        pages = WeeblyPage.objects.in_bulk(page_ids, field_name='page_id')
+        return [pages[page_id] for page_id in page_ids if page_id in pages]
+
+    def ancestor_ids(self):
+        tree = self.get_site_tree()
+        parent_id = self.parent_id
+        while parent_id and parent_id in tree:
+            yield parent_id
+            parent_id = tree[parent_id][0]
+
     def all_descendents(self):
-        current = self.children_qs().all()
+        children = {}
+        for page_id, (parent_id, _) in self.get_site_tree().items():
+            children.setdefault(parent_id, []).append(page_id)
+        descendent_ids = []
+        current = children.get(self.page_id, [])
         while current:
-            new_current = []
-            for page in current:
-                yield page
-                new_current += page.children_qs().all()
-            current = new_current
+            descendent_ids += current
+            current = [child_id for page_id in current for child_id in children.get(page_id, [])]
+        yield from WeeblyPage.pages_by_id(descendent_ids)
 
     def all_ancestors(self):
-        current = self
-        while current:
-            parent = current.get_parent()
-            if parent:
-                yield parent
-            current = parent
+        yield from WeeblyPage.pages_by_id(list(self.ancestor_ids()))
 
+    @cached_method
     def total_order(self):
-        order = [self.page_order]
-        parent = self
-        while True:
-            parent = parent.get_parent()
-            if not parent: break
-            order = [parent.page_order] + order
-        return order
+        tree = self.get_site_tree()
+        return [tree[parent_id][1] for parent_id in reversed(list(self.ancestor_ids()))] + [self.page_order]
 
+    @cached_method
     def total_url(self):
         if self.is_link():
             return self.page_url
         elif self.page_url:
-            return f'http://{self.site.domain}{self.page_url}'
+            return f'http://{self.site_domain_copy}{self.page_url}'
         else:
             return None
 
-    class Admin(ModelAdmin, SiteDomainMixin):
+    class Admin(ModelAdmin, LocalSiteDomainMixin):
         list_display = ['pk', 'page_id', 'title', 'site_domain', 'total_order', 'path']
         list_filter = []
-        search_fields = ['page_id', 'title', 'site__site_id', 'site__domain']
+        search_fields = ['page_id', 'title', 'site__site_id', 'site_domain_copy']
         readonly_fields = ['site', 'site_domain']
 
+        def get_changelist(self, request, **kwargs):
+            return WeeblyPageChangeList
+
         @mark_safe
         def path(self, obj):
-            return f'<a href="http://{obj.site.domain}{obj.page_url}" target="_blank">{obj.page_url}</a>'
+            return f'<a href="http://{obj.site_domain_copy}{obj.page_url}" target="_blank">{obj.page_url}</a>'
         path.admin_order_field = 'page_url'
 
 
+class WeeblyPageChangeList(ChangeList):
+    """
+    shares the site trees between the listed pages, so total_order doesn't load a tree per row
+    """
+    def get_results(self, request):
+        super().get_results(request)
+        WeeblyPage.share_site_trees(self.result_list)
+
+
+# noinspection PyUnusedLocal
+def set_site_domain(sender, instance, **kwargs):
+    """
+    pre_save handler for models that keep a copy of their site's domain
+    Only loads the site for a missing copy, otherwise WeeblySite.post_save keeps it up to date.
+    """
+    if sender.site.is_cached(instance) or not instance.site_domain_copy:
+        instance.site_domain_copy = instance.site.domain
+
+
+# share of the gross amount payable to weebly
+PAYABLE_RATE = to_decimal(0.3, 2)
+
+
 class WeeblyPaymentNotification(Model):
     class PaymentTerm(models.TextChoices):
         MONTH = 'month', 'Month'
@@ -498,7 +812,7 @@ class WeeblyPaymentNotification(Model):
     gross_amount = models.DecimalField(max_digits=10, decimal_places=2)
     payable_amount = models.DecimalField(max_digits=10, decimal_places=2, blank=True)
     currency = models.CharField(max_length=10, default='USD', blank=True, null=True)
-    notified_to_weebly = models.BooleanField(default=False)
+    notified_to_weebly = models.BooleanField(default=False, db_index=True)
     notified_to_weebly_on = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
@@ -507,20 +821,60 @@ class WeeblyPaymentNotification(Model):
     # noinspection PyUnusedLocal
     @staticmethod
     def pre_save(sender, instance, **kwargs):
-        instance.payable_amount = to_decimal(instance.gross_amount * to_decimal(0.3, 2), 2)
+        instance.payable_amount = to_decimal(instance.gross_amount * PAYABLE_RATE, 2)
 
     @staticmethod
     def notify_unnotified():
-        unnotified_count = WeeblyPaymentNotification.objects.filter(notified_to_weebly=False).count()
+        """
+        notifies all unnotified payments, with concurrent requests to weebly
+        weebly auths are resolved beforehand, once per site
+        """
+        unnotified = WeeblyPaymentNotification.objects.filter(notified_to_weebly=False).select_related('site')
+        unnotified_iterator = unnotified.iterator(chunk_size=500)
+        unnotified_count = 0
+        notified_count = 0
+        auth_by_site = {}
+
+        def notify(notif_auth):
+            notif, weebly_auth = notif_auth
+            logger.info(f'notifying {notif}')
+            notif.notify(weebly_auth=weebly_auth, save=False)
+
+        while True:
+            chunk = list(islice(unnotified_iterator, 500))
+            if not chunk: break
+            unnotified_count += len(chunk)
+            for notif in chunk:
+                if notif.site_id not in auth_by_site:
+                    auth_by_site[notif.site_id] = notif.get_weebly_auth()
+            try:
+                run_concurrently(notify, [(notif, auth_by_site[notif.site_id]) for notif in chunk])
+            finally:
+                # saving each chunk right away, even on errors, so notified payments are not notified twice
+                notified = [notif for notif in chunk if notif.notified_to_weebly]
+                WeeblyPaymentNotification.objects.bulk_update(notified,
+                                                              ['notified_to_weebly', 'notified_to_weebly_on'])
+                notified_count += len(notified)
         if unnotified_count == 0:
             logger.info('There are no unnotified payments')
         else:
-            logger.info(f'Notifying {unnotified_count} unnotified payments')
-        for notif in WeeblyPaymentNotification.objects.filter(notified_to_weebly=False).all():
-            logger.info(f'notifying {notif}')
-            notif.notify()
+            logger.info(f'Notified {notified_count} of {unnotified_count} unnotified payments')
+
+    def get_weebly_auth(self):
+        """
+        the weebly auth for notifying the payment, the DEFAULT_WEEBLY_AUTH if the site's one is not valid
+        """
+        weebly_auth = self.site.get_default_weebly_auth()
+        if weebly_auth and weebly_auth.is_valid:
+            return weebly_auth
+        logger.warning('Invalid weebly auth for notifying payment, using default weebly auth')
+        weebly_auth_pk = getattr(settings, 'DEFAULT_WEEBLY_AUTH', None)
+        return WeeblyAuth.objects.get(pk=weebly_auth_pk) if weebly_auth_pk else None
 
-    def notify(self):
+    def notify(self, weebly_auth=None, save=True):
+        """
+        notifies the payment to weebly. With save=False the notified flags are set but not saved.
+        """
         if self.notified_to_weebly:
             error = 'trying to notify an already notified payment'
             logger.error(error)
@@ -528,17 +882,13 @@ class WeeblyPaymentNotification(Model):
         if self.gross_amount == 0:
             logger.warning('trying to notify a 0 payment, marking as notified')
             self.notified_to_weebly = True
-            self.save()
+            if save: self.save()
             return {}
-        weebly_auth = self.site.get_default_weebly_auth()
-        if not weebly_auth.is_valid:
-            logger.warning('Invalid weebly auth for notifying payment, using default weebly auth')
-            weebly_auth_pk = getattr(settings, 'DEFAULT_WEEBLY_AUTH', None)
-            if weebly_auth_pk:
-                weebly_auth = WeeblyAuth.objects.get(pk=weebly_auth_pk)
-            else:
-                logger.error(f'Unable to notify payment {self} - Invalid weebly auth - Missing default weebly auth')
-                return {'error': 'Invalid weebly auth'}
+        if not weebly_auth:
+            weebly_auth = self.get_weebly_auth()
+        if not weebly_auth:
+            logger.error(f'Unable to notify payment {self} - Invalid weebly auth - Missing default weebly auth')
+            return {'error': 'Invalid weebly auth'}
 
         method = 'purchase' if self.purchase_not_refund else 'refund'
         if not settings.PRODUCTION: method = 'test' + method
@@ -557,7 +907,7 @@ class WeeblyPaymentNotification(Model):
         if 'error' not in rv:
             self.notified_to_weebly = True
             self.notified_to_weebly_on = timezone.now()
-            self.save()
+            if save: self.save()
         else:
             logger.error('error reporting payment: ' + rv['error'])
         return rv
@@ -572,32 +922,32 @@ class WeeblyPaymentNotification(Model):
 
 class WeeblyBlog(Model):
     site = models.ForeignKey(WeeblySite, related_name='blogs', on_delete=CASCADE)
-    blog_id = models.BigIntegerField()
+    blog_id = models.BigIntegerField(db_index=True)
     page_id = models.BigIntegerField()
     title = models.CharField(max_length=256)
+    site_domain_copy = models.CharField(max_length=512, null=True, blank=True, db_index=True)
 
     def __str__(self):
         return f'weebly_blog_{self.pk}'
 
-    def refresh_posts(self):
-        return refresh.refresh_posts(self)
+    def refresh_posts(self, weebly_auth=None):
+        return refresh.refresh_posts(self, weebly_auth=weebly_auth)
 
     def get_post_tags(self):
         rv = {}
-        for post in self.posts.all():
-            tags = json.loads(post.tags) if post.tags else {}
-            rv.update(tags)
+        for tags in self.posts.values_list('tags', flat=True):
+            if tags: rv.update(tags)
         return rv
 
-    class Admin(SiteDomainMixin, ModelAdmin):
+    class Admin(LocalSiteDomainMixin, ModelAdmin):
         list_display = ['blog_id', 'site_domain', 'title', 'page_id']
-        search_fields = ['blog_id', 'page_id', 'site__domain', 'title']
+        search_fields = ['blog_id', 'page_id', 'site_domain_copy', 'title']
         readonly_fields = ['site', 'site_domain']
 
 
 class WeeblyBlogPost(Model):
     blog = models.ForeignKey(WeeblyBlog, related_name='posts', on_delete=CASCADE)
-    post_id = models.BigIntegerField()
+    post_id = models.BigIntegerField(db_index=True)
     title = models.CharField(max_length=256)
     created_date = models.DateTimeField(null=True, blank=True)
 
@@ -608,18 +958,22 @@ class WeeblyBlogPost(Model):
     share_message = models.CharField(max_length=256, null=True, blank=True)
     seo_title = models.CharField(max_length=256, null=True, blank=True)
     seo_description = models.TextField(null=True, blank=True)
-    tags = models.TextField(null=True, blank=True)
+    tags = models.JSONField(default=dict, blank=True)
+    weebly_payload_hash = models.CharField(max_length=32, null=True, blank=True, editable=False)
 
     def __str__(self):
         return f'weebly_blog_post_{self.pk}'
 
-    def refresh_from_weebly(self):
-        return refresh.refresh_post(self)
+    def refresh_from_weebly(self, weebly_auth=None):
+        return refresh.refresh_post(self, weebly_auth=weebly_auth)
 
     class Admin(ModelAdmin):
         list_display = ['post_id', 'title', 'created_date', 'tags']
         readonly_fields = ['blog']
 
+        def get_queryset(self, request):
+            return super().get_queryset(request).defer('body', 'seo_description')
+
 
 class WeeblyStoreCategory(Model):
     site = models.ForeignKey(WeeblySite, related_name='store_categories', on_delete=CASCADE)
@@ -640,6 +994,9 @@ class WeeblyStoreCategory(Model):
         readonly_fields = ['site', 'site_domain']
         # inlines = [StoreCategoryTranslationInline]
 
+        def get_queryset(self, request):
+            return super().get_queryset(request).select_related('site', 'parent_category')
+
 
 class WeeblyStoreProduct(Model):
     site = models.ForeignKey(WeeblySite, related_name='store_products', on_delete=CASCADE)
@@ -647,6 +1004,8 @@ class WeeblyStoreProduct(Model):
     name = models.CharField(max_length=256)
     description = tinymce_models.HTMLField(blank=True, null=True)
     url = models.CharField(max_length=1024, blank=True, null=True)
+    site_domain_copy = models.CharField(max_length=512, null=True, blank=True, db_index=True)
+    weebly_payload_hash = models.CharField(max_length=32, null=True, blank=True, editable=False)
 
     def __str__(self):
         return f'product_{self.pk}:{self.name}'
@@ -667,13 +1026,7 @@ class WeeblyStoreProductOption(Model):
     product = models.ForeignKey(WeeblyStoreProduct, related_name='options', on_delete=CASCADE)
     option_id = models.BigIntegerField()
     name = models.CharField(max_length=256)
-    choices = models.TextField()
-
-    def get_choices_array(self):
-        return json.dumps(self.choices)
-
-    def set_choices_array(self, array):
-        self.choices = json.loads(array)
+    choices = models.JSONField(default=list)
 
     def __str__(self): return self.name
 
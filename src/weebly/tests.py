@@ -1,8 +1,14 @@
 import logging
-from django.test import TestCase
+from unittest import mock
+from django.test import TestCase, override_settings
 from django.utils import timezone
 from django.conf import settings
-from .models import WeeblyUser, WeeblySite, WeeblyAuth, WeeblyPaymentNotification
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from .models import WeeblyUser, WeeblySite, WeeblyAuth, WeeblyPage, WeeblyPaymentNotification, weebly_session, \
+    deferred_site_signals, cached_weebly_users
+from .signals import site_refreshed_signal
+from .util import run_concurrently
 from . import refresh
 
 logger = logging.getLogger(__name__)
@@ -84,6 +90,188 @@ class WeeblyTest(TestCase):
 
         site.refresh_pages()
 
+    def test_page_tree(self):
+        site = self.weebly_site
+        response_json = [
+            {'page_id': '1', 'title': 'page 1', 'page_order': 1, 'parent_id': None, 'page_url': 'page-1.html'},
+            {'page_id': '2', 'title': 'page 2', 'page_order': 2, 'parent_id': '1', 'page_url': 'page-2.html'},
+            {'page_id': '3', 'title': 'page 3', 'page_order': 3, 'parent_id': '2', 'page_url': 'page-3.html'},
+            {'page_id': '4', 'title': 'page 4', 'page_order': 4, 'parent_id': '1', 'page_url': 'page-4.html'},
+        ]
+        refresh.refresh_pages_from_data(site, response_json)
+        page_1 = site.pages.get(page_id=1)
+        page_3 = site.pages.get(page_id=3)
+        self.assertEqual([p.page_id for p in page_1.all_descendents()], [2, 4, 3])
+        self.assertEqual([p.page_id for p in page_3.all_ancestors()], [2, 1])
+        self.assertEqual(page_3.total_order(), [1, 2, 3])
+
+        pages = list(site.pages.order_by('page_id'))
+        with CaptureQueriesContext(connection) as queries:
+            WeeblyPage.share_site_trees(pages)
+            total_orders = [page.total_order() for page in pages]
+        self.assertEqual(len(queries), 1, 'the pages should share a single tree')
+        self.assertEqual(total_orders, [[1], [1, 2], [1, 2, 3], [1, 4]])
+
+    def test_refresh_query_count(self):
+        """
+        updating a list must not do a query per element
+        """
+        site = self.weebly_site
+
+        def pages_data(count, title):
+            return [{'page_id': str(i), 'title': f'{title} {i}', 'page_order': i, 'parent_id': None,
+                     'page_url': f'page-{i}.html'} for i in range(1, count + 1)]
+
+        def count_queries(count):
+            refresh.refresh_pages_from_data(site, pages_data(count, 'page'))
+            with CaptureQueriesContext(connection) as queries:
+                refresh.refresh_pages_from_data(site, pages_data(count, 'changed page'))
+            return len(queries)
+
+        self.assertEqual(count_queries(2), count_queries(20))
+
+    def test_site_domain(self):
+        site = self.weebly_site
+        refresh.refresh_pages_from_data(site, [{'page_id': '1', 'title': 'page 1', 'page_order': 1, 'parent_id': None,
+                                                'page_url': 'page-1.html'}])
+        with CaptureQueriesContext(connection) as queries:
+            site.save(update_fields=['weebly_payload_hash'])
+        self.assertEqual(len(queries), 1, 'saving other fields should not update the site domains')
+        site.domain = 'changed.example.com'
+        site.save()
+        self.assertEqual(site.pages.get(page_id=1).site_domain(), 'changed.example.com')
+
+    def test_deferred_site_signals(self):
+        site = self.weebly_site
+        received = []
+
+        def receiver(sender, **_):
+            received.append(sender)
+
+        site_refreshed_signal.connect(receiver)
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                with deferred_site_signals():
+                    run_concurrently(lambda _: site.signal_change(), range(3))
+                    self.assertEqual(received, [], 'signals should wait for the end of the batch')
+        finally:
+            site_refreshed_signal.disconnect(receiver)
+        self.assertEqual(received, [site], 'the site should be signaled once')
+
+    def test_cached_weebly_users(self):
+        user_id = self.weebly_user.user_id
+        with cached_weebly_users():
+            with CaptureQueriesContext(connection) as queries:
+                users = [WeeblyUser.get_or_create_cached(str(user_id)) for _ in range(3)]
+        self.assertEqual(len(queries), 1, 'the user should be looked up once')
+        self.assertTrue(all(user.pk == self.weebly_user.pk for user in users))
+        with CaptureQueriesContext(connection) as queries:
+            WeeblyUser.get_or_create_cached(user_id)
+        self.assertEqual(len(queries), 1, 'outside the context the user should not be cached')
+
+    def test_refresh_store_categories(self):
+        site = self.weebly_site
+        response_json = [
+            {'category_id': '3', 'name': 'category 3', 'parent_category_id': '2'},
+            {'category_id': '2', 'name': 'category 2', 'parent_category_id': '1'},
+            {'category_id': '1', 'name': 'category 1', 'parent_category_id': None},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            refresh.refresh_store_categories_from_data(site, response_json)
+        categories = {c.category_id: c for c in site.store_categories.select_related('parent_category')}
+        self.assertEqual(len(categories), 3)
+        self.assertIsNone(categories[1].parent_category)
+        self.assertEqual(categories[2].parent_category.category_id, 1)
+        self.assertEqual(categories[3].parent_category.category_id, 2)
+
+        response_json[0]['parent_category_id'] = '1'
+        with CaptureQueriesContext(connection) as second_queries:
+            refresh.refresh_store_categories_from_data(site, response_json)
+        self.assertLessEqual(len(second_queries), len(queries))
+        self.assertEqual(site.store_categories.get(category_id=3).parent_category.category_id, 1)
+
+        # deleting the parents cascades to their children, a child still in the data must be created again
+        response_json = [{'category_id': '3', 'name': 'category 3', 'parent_category_id': None}]
+        refresh.refresh_store_categories_from_data(site, response_json)
+        categories = list(site.store_categories.all())
+        self.assertEqual([c.category_id for c in categories], [3])
+        self.assertIsNone(categories[0].parent_category)
+
+    def test_refresh_blogs_in_transaction(self):
+        """
+        posts are requested concurrently but saved in this thread, inside the test transaction
+        """
+        site = self.weebly_site
+
+        def request(method, url, **_):
+            if url.endswith('/blogs'):
+                return self.weebly_response([{'blog_id': '1', 'page_id': '1', 'title': 'blog'}])
+            if url.endswith('/posts'):
+                return self.weebly_response([{'post_id': str(i), 'post_title': f'post {i}', 'created_date': 1500000000}
+                                             for i in range(1, 4)])
+            post_id = url.rsplit('/', 1)[1]
+            return self.weebly_response({'post_id': post_id, 'post_title': f'post {post_id}',
+                                         'created_date': 1500000000, 'updated_date': 1500000000,
+                                         'post_body': f'body {post_id} &amp; more', 'post_link': '', 'post_url': '',
+                                         'seo_title': '', 'seo_description': '', 'tags': {}})
+
+        with mock.patch.object(weebly_session, 'request', side_effect=request):
+            rv = site.refresh_blogs(refresh_posts=True, weebly_auth=self.weebly_auth)
+        self.assertNotIn('error', rv)
+        posts = {post.post_id: post for post in site.blogs.get(blog_id=1).posts.all()}
+        self.assertEqual(len(posts), 3)
+        self.assertEqual(posts[2].body, 'body 2 & more')
+
+    @staticmethod
+    def weebly_response(resp_json):
+        response = mock.Mock(status_code=200)
+        response.json.return_value = resp_json
+        return response
+
+    def test_concurrent_requests_auth_validity(self):
+        """
+        the auth validity is checked and saved in this thread, inside the test transaction
+        """
+        site = self.weebly_site
+        weebly_auth = self.weebly_auth
+        weebly_auth.is_valid = False
+        weebly_auth.save()
+        pages = [{'page_id': '1', 'title': 'page 1', 'page_order': 1, 'parent_id': None, 'page_url': 'page-1.html'}]
+        with mock.patch.object(weebly_session, 'request', return_value=self.weebly_response(pages)):
+            rv = refresh.refresh_pages(site, weebly_auth=weebly_auth)
+        self.assertNotIn('error', rv)
+        self.assertEqual(site.pages.count(), 1)
+        weebly_auth.refresh_from_db()
+        self.assertTrue(weebly_auth.is_valid)
+
+        error_response = mock.Mock(status_code=401)
+        error_response.json.return_value = {'error': {'message': 'Unknown api key'}}
+        with mock.patch.object(weebly_session, 'request', return_value=error_response):
+            rv = refresh.refresh_pages(site, weebly_auth=weebly_auth)
+        self.assertIn('error', rv)
+        weebly_auth.refresh_from_db()
+        self.assertFalse(weebly_auth.is_valid)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_request_cache(self):
+        weebly_auth = self.weebly_auth
+        with mock.patch.object(weebly_session, 'request', return_value=self.weebly_response({})) as request:
+            weebly_auth.weebly_request('/v1/user', cache_timeout=60)
+            weebly_auth.weebly_request('/v1/user', cache_timeout=60)
+            self.assertEqual(request.call_count, 1, 'the second GET should be cached')
+            weebly_auth.weebly_request('/v1/user/sites/1/publish', method='post')
+            weebly_auth.weebly_request('/v1/user', cache_timeout=60)
+            self.assertEqual(request.call_count, 3, 'the POST should invalidate the cached GET')
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_request_dummy_cache(self):
+        weebly_auth = self.weebly_auth
+        with mock.patch.object(weebly_session, 'request', return_value=self.weebly_response({})) as request:
+            weebly_auth.weebly_request('/v1/user', cache_timeout=60)
+            rv, _ = weebly_auth.weebly_request('/v1/user/sites/1/publish', method='post')
+            self.assertNotIn('error', rv)
+            self.assertEqual(request.call_count, 2)
+
     def create_payment_notification(self, gross_amount):
         notification = WeeblyPaymentNotification.objects.create(
             site=self.weebly_site,
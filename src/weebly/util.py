@@ -1,8 +1,12 @@
 import logging
+import hashlib
 import html
 import json
-from collections import OrderedDict
-from django.db import IntegrityError
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from operator import attrgetter
+from django.db import IntegrityError, connections, transaction
 from marto_python.email.email import send_email_to_admins
 from marto_python.url import is_absolute
 from marto_python.util import is_valid_email
@@ -10,7 +14,10 @@ from marto_python.collection_utils import map_dict
 
 logger = logging.getLogger(__name__)
 
+nbsp_table = str.maketrans({' ': '&nbsp;'})
 
+
+@transaction.atomic
 def update_list_of(site,
                    json_data,
                    object_name,
@@ -21,6 +28,7 @@ def update_list_of(site,
                    properties_mapping):
     """
     updates the list of things in the database according to a response from weebly api
+    runs in a single transaction
 
     params:
 
@@ -44,74 +52,118 @@ def update_list_of(site,
 
     changes = False
 
-    original_elems = OrderedDict()
-    data_elems = OrderedDict()
-    for original_elem in related_manager.all():
-        elem_id = getattr(original_elem, id_property_elem)
-        original_elems[elem_id] = original_elem
-    for data_elem in json_data:
-        data_id = int(data_elem[id_property_data])
-        data_elems[data_id] = data_elem
+    original_elems = {getattr(elem, id_property_elem): elem for elem in related_manager.all()}
+    data_elems = {int(data_elem[id_property_data]): data_elem for data_elem in json_data}
 
     log_str = f'{site} - list update - {object_name}'
     logger.debug(f'{log_str} - {len(original_elems)} original - {len(data_elems)} data')
 
-    for elem_id, original_elem in original_elems.items():
-        if elem_id not in data_elems:
-            changes = True
-            log(f'{site} - deleting - {object_name} {elem_id}', log=True)
-            original_elem.delete()
+    deleted_ids = sorted(original_elems.keys() - data_elems.keys())
+    for elem_id in deleted_ids:
+        log(f'{site} - deleting - {object_name} {elem_id}', log=True)
+    if deleted_ids:
+        changes = True
+        related_manager.filter(**{f'{id_property_elem}__in': deleted_ids}).delete()
+        # the delete can cascade to other elements in the list, those are created again
+        remaining_ids = set(related_manager.values_list(id_property_elem, flat=True))
+        original_elems = {elem_id: elem for elem_id, elem in original_elems.items() if elem_id in remaining_ids}
 
+    new_elems = []
+    updated_elems = []
     for data_id, data_elem in data_elems.items():
         elem_log = f'{object_name} {data_id}'
-        elem = related_manager.filter(**{id_property_elem: data_id}).first()
-        is_new = elem is None
-        if is_new:
+        elem = original_elems.get(data_id)
+        if elem is None:
             log(f'creating - {elem_log}', log=True)
             elem = new_elem_func()
             setattr(elem, id_property_elem, data_id)
             update_object_from_data(elem, properties_mapping, data_elem)
-            try:
-                elem.save()
-                related_manager.add(elem)
-                changes = True
-            except IntegrityError:
-                # if we get integrity error, fetch and set as existing
-                elem = related_manager.filter(**{id_property_elem: data_id}).first()
+            new_elems.append((elem, data_elem))
+        elif update_object_from_data(elem, properties_mapping, data_elem):
+            log(f'updating - {elem_log}', log=True)
+            updated_elems.append(elem)
+        else:
+            log(f'already exists - {elem_log}')
+
+    model = related_manager.model
+    if new_elems:
+        changes = True
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create([elem for elem, _ in new_elems], batch_size=1000)
+        except IntegrityError:
+            # some of them were created in the meantime, creating one by one
+            for elem, data_elem in new_elems:
+                elem_log = f'{object_name} {getattr(elem, id_property_elem)}'
+                try:
+                    # savepoint so an integrity error doesn't break the whole update
+                    with transaction.atomic():
+                        elem.save()
+                    continue
+                except IntegrityError:
+                    pass
+                # if we get integrity error, fetch and update as existing
+                elem = related_manager.filter(**{id_property_elem: getattr(elem, id_property_elem)}).first()
                 if elem:
-                    is_new = False
                     log(f'integrity error - updating - {elem_log}', log=True)
+                    if update_object_from_data(elem, properties_mapping, data_elem):
+                        updated_elems.append(elem)
                 else:
                     # if integrity error AND element does not exist, log error
                     # FIXME: remove all this for django-weebly
                     log('')
                     log('Data:')
                     log('')
-                    for line in json.dumps(json_data, indent=4).split('\n'):
-                        line = line.replace(' ', '&nbsp;')
+                    for line in json.dumps(json_data, indent=4).translate(nbsp_table).splitlines():
                         log(line)
                     log_msg = f'{log_str} - integrity error and not exists - {elem_log}'
                     logger.error(log_msg, exc_info=True)
-                    send_email_to_admins(log_msg, '<br/>'.join(log_strs))
+                    # sending after commit, so it doesn't hold the transaction
+                    email_body = '<br/>'.join(log_strs)
+                    transaction.on_commit(lambda msg=log_msg, body=email_body: send_email_to_admins(msg, body))
                     log_strs = []
-                    continue
-        save = update_object_from_data(elem, properties_mapping, data_elem)
-        if not is_new:
-            if save:
-                log(f'updating - {elem_log}', log=True)
-            else:
-                log(f'already exists - {elem_log}')
-        if save or is_new:
-            changes = True
-            elem.save()
+    if updated_elems:
+        changes = True
+        update_fields = [obj_property for _, obj_property, _ in properties_mapping]
+        model.objects.bulk_update(updated_elems, update_fields, batch_size=1000)
     return {'changes': changes}
 
 
+class PropertiesMapping(list):
+    """
+    A properties mapping defined once and used for many updates.
+    The properties are split up front by whether they have a transform function,
+    so updating doesn't check for it on every property, and the attribute getters are built once.
+    """
+    def __init__(self, properties_mapping):
+        super().__init__(properties_mapping)
+        self.plain = [(data_property, attrgetter(obj_property), obj_property)
+                      for data_property, obj_property, transform_func in self if not transform_func]
+        self.transformed = [(data_property, attrgetter(obj_property), obj_property, transform_func)
+                            for data_property, obj_property, transform_func in self if transform_func]
+
+    def update(self, obj, data):
+        save = False
+        for data_property, getter, obj_property in self.plain:
+            data_val = data[data_property]
+            if getter(obj) != data_val:
+                setattr(obj, obj_property, data_val)
+                save = True
+        for data_property, getter, obj_property, transform_func in self.transformed:
+            data_val = transform_func(data[data_property])
+            if getter(obj) != data_val:
+                setattr(obj, obj_property, data_val)
+                save = True
+        return save
+
+
 def update_object_from_data(obj, properties_mapping, data):
     """
     updates the object and returns true if the object must be saved
     Does NOT save
     """
+    if isinstance(properties_mapping, PropertiesMapping):
+        return properties_mapping.update(obj, data)
     save = False
     for data_property, obj_property, transform_func in properties_mapping:
         obj_val = getattr(obj, obj_property)
@@ -124,6 +176,13 @@ def update_object_from_data(obj, properties_mapping, data):
     return save
 
 
+def get_payload_hash(data):
+    """
+    digest of a weebly response, to skip updating from it when it didn't change since the last refresh
+    """
+    return hashlib.blake2b(json.dumps(data, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
 def compose(f, g):
     return lambda x: f(g(x))
 
@@ -141,9 +200,9 @@ def unescape_func(val):
     """
     helper for update funcs
     """
-    if not val: return val
+    if not val or '&' not in val: return val  # nothing to unescape, most values
     val = val.replace('&amp;amp;', '&')  # Fixing strange weebly double HTML encoding
-    return html.unescape(val) if val is not None else None
+    return html.unescape(val)
 
 
 def url_func(url):
@@ -157,7 +216,7 @@ def url_func(url):
 
 def unescape_dict_val_func(val):
     if not val: return val
-    return map_dict(val, lambda tag, name: html.unescape(name))
+    return map_dict(val, lambda tag, name: unescape_func(name))
 
 
 def valid_email_func(val):
@@ -170,3 +229,36 @@ def find_in_map_list(l, property_name, id_value):
         if elem_id == id_value:
             return elem
     return None
+
+
+def run_concurrently(func, elems, max_workers=10):
+    """
+    calls func for each elem from a pool of threads, so the weebly api round trips overlap.
+    Each call runs in a copy of the caller's context, so context variables set by the caller are seen.
+    DB connections are per thread, so they are closed after each call.
+    """
+    context = contextvars.copy_context()
+
+    def run(elem):
+        try:
+            return context.copy().run(func, elem)
+        finally:
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run, elems))
+
+
+def cached_method(func):
+    """
+    caches the result of a method without arguments in the instance.
+    Like cached_property, but it is still called as a method.
+    """
+    cache_attr = f'_{func.__name__}_cache'
+
+    @wraps(func)
+    def wrapper(self):
+        if cache_attr not in self.__dict__:
+            self.__dict__[cache_attr] = func(self)
+        return self.__dict__[cache_attr]
+    return wrapper